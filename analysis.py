@@ -1,6 +1,106 @@
-import json
+from query_gpt import PROMPT_VERSION
+from response_cache import ResponseCache, make_cache_key
+
+from collections import defaultdict
+from types import MappingProxyType
+import asyncio
+import orjson
+import os
+import re
+import unicodedata
+
+## Inverted index of character shingles. If quote a contains quote b, a contains every shingle of b;
+## so any one shingle of b (the rarest gives the fewest candidates) finds the quotes that may contain it,
+## and the first shingle of each indexed quote (its anchor) finds the indexed quotes a new quote may contain.
+## Works on str or utf-8 bytes alike; a utf-8 byte string contains another only if the decoded text does.
+class QuoteIndex:
+    shingle_len = 5
+
+    def __init__(self):
+        self.ids_by_shingle = defaultdict(list)
+        self.ids_by_anchor = defaultdict(list)
+        self.short_quotes = [] # [(quote_id, norm_quote)] for quotes with no full shingle
+
+    def get_shingles(self, norm_quote):
+        k = self.shingle_len
+        return {norm_quote[i:i+k] for i in range(len(norm_quote) - k + 1)}
+
+    def add(self, quote_id, norm_quote):
+        if len(norm_quote) < self.shingle_len:
+            self.short_quotes.append((quote_id, norm_quote))
+            return
+        for shingle in self.get_shingles(norm_quote):
+            self.ids_by_shingle[shingle].append(quote_id)
+        self.ids_by_anchor[norm_quote[:self.shingle_len]].append(quote_id)
+
+    ## Returns ids of indexed quotes that may contain, or be contained in, norm_quote
+    def find_candidates(self, norm_quote):
+        candidates = {quote_id for quote_id, short_quote in self.short_quotes if short_quote in norm_quote}
+        if len(norm_quote) < self.shingle_len:
+            candidates.update(quote_id for quote_ids in self.ids_by_anchor.values() for quote_id in quote_ids)
+            candidates.update(quote_id for quote_id, _ in self.short_quotes)
+            return sorted(candidates)
+        shingles = self.get_shingles(norm_quote)
+        rarest_shingle = min(shingles, key=lambda shingle: len(self.ids_by_shingle.get(shingle, ())))
+        candidates.update(self.ids_by_shingle.get(rarest_shingle, []))
+        for shingle in shingles:
+            candidates.update(self.ids_by_anchor.get(shingle, []))
+        return sorted(candidates)
+
+_PUNCTUATION = re.compile(r"[^\w\s]+")
+
+## Canonical form used to match quotes: GPT often returns the same passage with different spacing,
+## line breaks, punctuation or Unicode composition (precomposed vs combining accents), so those are
+## dropped or unified before the containment check; casefold also matches e.g. "ß" with "ss"
+def normalize_quote(quote):
+    quote = unicodedata.normalize("NFC", quote).casefold()
+    return " ".join(_PUNCTUATION.sub("", quote).split()).encode("utf-8")
+
+## Disjoint sets of ids; the smallest id of each set is its root
+class UnionFind:
+    def __init__(self):
+        self.parents = []
+
+    def add(self):
+        self.parents.append(len(self.parents))
+        return len(self.parents) - 1
+
+    def find(self, i):
+        while self.parents[i] != i:
+            self.parents[i] = self.parents[self.parents[i]]
+            i = self.parents[i]
+        return i
+
+    def union(self, i, j):
+        root_i, root_j = self.find(i), self.find(j)
+        if root_i != root_j:
+            self.parents[max(root_i, root_j)] = min(root_i, root_j)
+
+    ## Returns each set as a sorted list of ids, ordered by the set's smallest id
+    def groups(self):
+        groups = {}
+        for i in range(len(self.parents)):
+            groups.setdefault(self.find(i), []).append(i)
+        return list(groups.values())
+
+## Strict structured-output schemas require every property and no others
+def json_object_schema(properties):
+    return {"type": "object", "properties": properties, "required": list(properties), "additionalProperties": False}
 
 class GPTAnalyzer:
+    ## Minimum cosine similarity between variable (name/description/context) embeddings for a cached response to be reused
+    semantic_threshold = 0.95
+    ## Maximum number of GPT requests in flight at once
+    max_concurrency = 16
+    ## Characters of extracted text on a typical text-only policy document page
+    chars_per_page = 3000
+    ## Fixed per analyzer type; the get_* methods below return these
+    chunk_size = 200
+    output_headers = ("Variable Name", "GPT Response")
+    resp_format = "json_object"
+    __slots__ = ("pdfs", "main_query", "variable_specs", "email", "output_fmt", "additional_info", "use_cache", "_cache",
+                 "_response_header", "_queries")
+
     def __init__(self, pdfs, main_query, variable_specs, email, output_fmt, additional_info):
         self.pdfs = pdfs
         self.main_query = main_query
@@ -8,38 +108,62 @@ class GPTAnalyzer:
         self.email = email
         self.output_fmt = output_fmt
         self.additional_info = additional_info
+        ## When False, cached responses are not reused (fresh ones are still stored, replacing the old)
+        self.use_cache = True
+        self._cache = ResponseCache("gpt_cache.sqlite")
+        ## Header of the column holding each GPT response; headers are fixed once the analyzer is built
+        self._response_header = self.get_output_headers()[1]
+        ## variable_name -> rendered instructions; identical for every PDF in the batch, so built once per variable
+        self._queries = {}
     
     def __str__(self):
         class_name = self.__class__.__name__
-        return f"{class_name} -- PDFS: {self.pdfs}, Main Query: {self.main_query}, Variables: {self.variable_specs}, Email: {self.email}"
+        pdf_fnames = ", ".join(os.path.basename(pdf) for pdf in self.pdfs)
+        return f"{class_name} -- PDFS ({len(self.pdfs)}): {pdf_fnames}, Main Query: {self.main_query}, Variables: {self.variable_specs}, Email: {self.email}"
 
     def output_fmt_prompt(self, var_name):
         pass
 
+    def variable_query(self, var_name, col_spec, context):
+        query = self._queries.get(var_name)
+        if query is None:
+            main_query = f"{self.main_query.format(variable_name=var_name, variable_description=col_spec, context=context)} \n\n"
+            main_query = self.optional_add_categorization(var_name, main_query)
+            output_prompt = self.output_fmt_prompt(var_name)
+            if len(output_prompt) > 1:
+                output_prompt = " " + output_prompt
+            query = self._queries[var_name] = f'<instructions>{main_query}.{output_prompt}</instructions>'
+        return query
+
     def format_gpt_response(self, resp):
         pass
     
     def get_chunk_size(self):
-        return 200
+        return self.chunk_size
 
     ## policy_info: {var_name: gpt response from above function}
     ## returns: {row_id: {"col_name": val, ...}}
     def get_results(self, policy_info):
         gpt_responses = {}
-        hdr = self.get_output_headers()[1]
+        hdr = self._response_header
         for var_name, var_val in policy_info.items():
-            if var_val.count('"')==2 and var_val[0]=='"' and var_val[-1]=='"':
+            if len(var_val) >= 2 and var_val[0] == var_val[-1] == '"' and var_val.count('"') == 2:
                 var_val = var_val[1:-1]
-            if len(var_val) > len(var_name):
-                if var_val[:len(var_name)] == var_name:
-                    var_val = var_val.replace(f"{var_name}: ", "", 1) 
-            gpt_responses[var_name] = {hdr: var_val}
+            gpt_responses[var_name] = {hdr: var_val.removeprefix(f"{var_name}: ")}
         return gpt_responses
 
     def get_output_headers(self):
-        return ["Variable Name", "GPT Response"]
+        return self.output_headers
     
-    def get_num_excerpts(self, num_pages):
+    ## Pages' worth of text in a document: sparse (e.g. graphics-heavy) PDFs count for less than their page count,
+    ## dense ones for more. Falls back to the page count when the character count is unknown.
+    def get_text_pages(self, num_pages, char_count=None):
+        if char_count is None:
+            return num_pages
+        return int(char_count / self.chars_per_page)
+
+    def get_num_excerpts(self, num_pages, char_count=None):
+        num_pages = self.get_text_pages(num_pages, char_count)
         if num_pages<100:
             return 40
         else:
@@ -49,62 +173,140 @@ class GPTAnalyzer:
         return query
 
     def resp_format_type(self):
-        return "json_object"
+        return self.resp_format
+
+    ## JSON schema the response must follow (enforced by OpenAI structured outputs); None for free-form json/text
+    def response_schema(self):
+        return None
+
+    def response_format(self):
+        schema = self.response_schema()
+        if schema is None:
+            return {"type": self.resp_format_type()}
+        return {"type": "json_schema", "json_schema": {"name": "response", "strict": True, "schema": schema}}
+
+    ## Returns a cached response for this prompt (exact match first, then one for a near-duplicate variable
+    ## description over the same excerpts), only awaiting GPT (call_fn) on a cache miss. var_embedding is the
+    ## variable's name/description/context embedding from embed_schema, so no extra embedding is requested; everything
+    ## else in the prompt (main query template, output format, categorization) must match exactly, so editing it
+    ## never returns an earlier answer.
+    async def cached_or_call(self, gpt_model, var_name, var_embedding, query, excerpts, run_on_full_text, call_fn):
+        label, resp_fmt = self.__class__.__name__, self.response_format()
+        key = make_cache_key(PROMPT_VERSION, gpt_model, label, resp_fmt, var_name, query, excerpts, run_on_full_text)
+        scope = make_cache_key(PROMPT_VERSION, gpt_model, label, resp_fmt, var_name, self.main_query,
+                               self.output_fmt_prompt(var_name), self.optional_add_categorization(var_name, ""),
+                               excerpts, run_on_full_text)
+        # SQLite reads and writes block (up to the lock timeout under concurrent sessions), so they run off the event loop
+        if self.use_cache:
+            resp = await asyncio.to_thread(self._cache.get, key)
+            if resp is not None:
+                return resp
+            resp = await asyncio.to_thread(self._cache.get_similar, scope, var_embedding, self.semantic_threshold)
+            if resp is not None and self.is_valid_response(resp):
+                await asyncio.to_thread(self._cache.set, key, resp)
+                return resp
+        resp = await call_fn()
+        # A truncated or unparseable response (or a refusal) is returned but not stored, so rerunning queries GPT again
+        if resp is not None and self.is_valid_response(resp):
+            await asyncio.to_thread(self._cache.set, key, resp, scope, var_embedding)
+        return resp
+
+    def is_valid_response(self, resp):
+        if self.resp_format_type() != "json_object":
+            return True
+        try:
+            self.format_gpt_response(resp)
+            return True
+        except (ValueError, KeyError, TypeError):
+            return False
+
+
+_DEFAULT_OUTPUT_FMT_PROMPT = ("Return your response in the following json format: \n "
+                              + orjson.dumps({"value": "...", "relevant_page_numbers": "..."}).decode())
+
 
 class DefaultAnalyzer(GPTAnalyzer):
+    __slots__ = ()
+
     def __init__(self, pdfs, main_query, variable_specs, email, output_fmt, additional_info):
         super().__init__(pdfs, main_query, variable_specs, email, output_fmt, additional_info) 
 
     def output_fmt_prompt(self, var_name):
-        output_fmt_str = "{'value': '...', 'relevant_page_numbers': '...'}"
-        return f"Return your response in the following json format: \n {output_fmt_str}"
+        return _DEFAULT_OUTPUT_FMT_PROMPT
     
+    def response_schema(self):
+        return json_object_schema({"value": {"type": "string"}, "relevant_page_numbers": {"type": "string"}})
+
     def format_gpt_response(self, resp):
-        return f"{json.loads(resp)['value']} [page(s) {resp['relevant_page_numbers']}]" 
+        resp_json = orjson.loads(resp)
+        return f"{resp_json['value']} [page(s) {resp_json['relevant_page_numbers']}]"
 
 
 class CustomOutputAnalyzer(GPTAnalyzer):
+    resp_format = "text"
+    __slots__ = ("_output_detail_map",)
+
     def __init__(self, pdfs, main_query, variable_specs, email, output_fmt, additional_info):
         super().__init__(pdfs, main_query, variable_specs, email, output_fmt, additional_info) 
+        df = self.additional_info["output_detail"]
+        self._output_detail_map = dict(zip(df["variable_name"], df["output_detail"]))
 
     def output_fmt_prompt(self, var_name):
-        df = self.additional_info["output_detail"]
-        output_detail = df.loc[df["variable_name"] == var_name, "output_detail"].values[0]
+        output_detail = self._output_detail_map[var_name]
         return self.additional_info["custom_output_fmt"].replace("{output_detail}", output_detail)
     
     def format_gpt_response(self, resp):
         return resp
 
-    def resp_format_type(self):
-        return "text"
-
 
 class QuoteAnalyzer(GPTAnalyzer):
+    semantic_threshold = 0.99
+    __slots__ = ("_subcats", "_subcat_keys", "_subcat_options", "_output_fmt_prompt")
+
     def __init__(self, pdfs, main_query, variable_specs, email, output_fmt, additional_info):
+        ## Subcategory columns and the json keys GPT labels quotes with; set first as they determine the output headers
+        self._subcats, self._subcat_keys, self._subcat_options = (), (), {}
+        if output_fmt == "quotes_sorted_and_labelled":
+            self._subcats = tuple(additional_info.columns[1:])
+            self._subcat_keys = tuple(f"relevant_{subcat.lower().replace(' ', '_')}" for subcat in self._subcats)
+            ## variable_name -> the options listed for each subcategory
+            self._subcat_options = {row[0]: row[1:] for row in additional_info.itertuples(index=False)}
         super().__init__(pdfs, main_query, variable_specs, email, output_fmt, additional_info) 
+        ## The output format is the same for every variable, so it is built once
+        self._output_fmt_prompt = self.build_output_fmt_prompt()
 
-    def output_fmt_prompt(self, var_name):
+    def build_output_fmt_prompt(self):
         if self.output_fmt == "quotes_gpt_resp":
             return "Provide an exhaustive list of relevant quotes."
         else:
             output_json_fmt = {'list_of_quotes': [{'quote': '...', 'page_number': '...'}]}
-            if self.output_fmt == "quotes_sorted_and_labelled":
-                for col in self.additional_info.columns[1:]:
-                    label = f"relevant_{col.lower().replace(' ', '_')}"
-                    output_json_fmt["list_of_quotes"][0][label] = "..."
-            output_fmt_str = str(output_json_fmt).replace("]}", ", ...}]")
+            for label in self._subcat_keys:
+                output_json_fmt["list_of_quotes"][0][label] = "..."
+            ## Valid JSON, with "..." after the example quote to show the list continues
+            output_fmt_str = orjson.dumps(output_json_fmt).decode().replace("}]}", "}, ...]}")
             return f"Return your response in the following json format: \n {output_fmt_str}"
+
+    def output_fmt_prompt(self, var_name):
+        return self._output_fmt_prompt
+
+    def response_schema(self):
+        if self.output_fmt == "quotes_gpt_resp":
+            return None
+        quote_properties = {"quote": {"type": "string"}, "page_number": {"type": "string"}}
+        for label in self._subcat_keys:
+            quote_properties[label] = {"type": "string"}
+        return json_object_schema({"list_of_quotes": {"type": "array", "items": json_object_schema(quote_properties)}})
     
     def optional_add_categorization(self, var_name, query):
         if self.output_fmt=="quotes_sorted_and_labelled":
-            row = self.additional_info[self.additional_info['variable_name'] == var_name].iloc[0]
-            subcat_label1 = self.additional_info.columns[1]
-            query += f"For each relevant quote, select which {subcat_label1} it addresses from the following list ({row[subcat_label1]})"
-            if len(self.additional_info.columns) > 2:
-                if self.additional_info.columns[2]:
-                    subcat_label2 = self.additional_info.columns[1]
-                    query += f" and which {subcat_label2} it addresses from the following list ({row[subcat_label1]})"
-            query += "."
+            subcat_options = self._subcat_options[var_name]
+            subcat_label1 = self._subcats[0]
+            categorization = [f"For each relevant quote, select which {subcat_label1} it addresses from the following list ({subcat_options[0]})"]
+            if len(self._subcats) > 1:
+                if self._subcats[1]:
+                    subcat_label2 = self._subcats[1]
+                    categorization.append(f"which {subcat_label2} it addresses from the following list ({subcat_options[1]})")
+            query += " and ".join(categorization) + "."
         return query
 
     ## Returns either an unstructured string or a json object list
@@ -112,7 +314,7 @@ class QuoteAnalyzer(GPTAnalyzer):
         if self.output_fmt == "quotes_gpt_resp":
             return resp
         else:  
-            return json.loads(resp)["list_of_quotes"]
+            return orjson.loads(resp)["list_of_quotes"]
 
     ## policy_info: {var_name: gpt response from above function}
     ## returns: {row_id: {"col_name": val, ...}}
@@ -120,70 +322,62 @@ class QuoteAnalyzer(GPTAnalyzer):
         if self.output_fmt == "quotes_gpt_resp":
             quotes = {}
             for var_name, relevant_quotes_gpt_resp in policy_info.items():
-                quotes[var_name] = {self.get_output_headers()[1]: relevant_quotes_gpt_resp}
+                quotes[var_name] = {self._response_header: relevant_quotes_gpt_resp}
             return quotes
         elif self.output_fmt == "quotes_structured":
             all_quotes = {}
             for var_name, quotes_json in policy_info.items():
-                quotes_for_var = ""
-                ctr = 1
-                for quote_json in quotes_json:
-                    quotes_for_var += f"{str(ctr)}. {quote_json['quote']} [page {quote_json['page_number']}]. \n"
-                    ctr+=1
-                all_quotes[var_name] = {self.get_output_headers()[1]: quotes_for_var}
+                quotes_for_var = "".join(f"{ctr}. {quote_json['quote']} [page {quote_json['page_number']}]. \n"
+                                         for ctr, quote_json in enumerate(quotes_json, start=1))
+                all_quotes[var_name] = {self._response_header: quotes_for_var}
             return all_quotes
         else:
-            def is_similar_quote(q1, q2):
-                q1, q2 = q1.lower().strip(), q2.lower().strip()
-                return q1 in q2 or q2 in q1 or q1==q2 or q1 is q2
-            temp_quotes = []
-            all_quotes = {}
+            ## Quotes are normalized once when found (see normalize_quote), to utf-8 bytes so the substring checks
+            ## and shingle slicing skip str's per-character width handling
+            def is_similar_quote(norm_q1, norm_q2):
+                ## Only the shorter quote can be contained in the longer one, so one search suffices
+                if len(norm_q1) > len(norm_q2):
+                    norm_q1, norm_q2 = norm_q2, norm_q1
+                return norm_q1 in norm_q2
+            found_quotes = [] # [(quote, var_name, subcat_vals, normalized quote)] in the order they were found
+            quote_index = QuoteIndex()
+            similar_quotes = UnionFind()
+            ## Exact repeats (the common case) join the first quote with the same normalized text in O(1);
+            ## that quote is already indexed and merged with everything similar to it
+            first_id_by_norm = {}
             for var_name, quotes_json in policy_info.items():
                 for quote_json in quotes_json:
                     curr_quote = f"{quote_json['quote']} [page {quote_json['page_number']}]"
-                    subcat_vals = None
-                    if self.output_fmt=="quotes_sorted_and_labelled":        
-                        subcats = self.additional_info.columns[1:]            
-                        subcat_vals = [quote_json[f"relevant_{subcat.replace(' ', '_').lower()}"] for subcat in subcats]
-                    found_similar = False
-                    for i, found_quote_val_list in enumerate(temp_quotes):
-                        existing_quote, var_names = found_quote_val_list[0], found_quote_val_list[1]
-                        if is_similar_quote(curr_quote, existing_quote):
-                            add_labels_to_quote = [existing_quote, f"{var_names}, {var_name}"]
-                            if subcat_vals:
-                                for i, subcat_val in enumerate(subcat_vals):
-                                    add_labels_to_quote.append(f"{found_quote_val_list[i+1]}, {subcat_val}")
-                            temp_quotes[i] = add_labels_to_quote
-                            found_similar = True
-                            break
-                    if not found_similar:
-                        labels_for_quote = [curr_quote, var_name]
-                        if subcat_vals:
-                            for subcat_val in subcat_vals:
-                                labels_for_quote.append(subcat_val)
-                        temp_quotes.append(labels_for_quote)
-            for quote_val_list in temp_quotes:
-                quote, var_names = quote_val_list[0], quote_val_list[1]
-                all_quotes[quote] = {self.get_output_headers()[1]: var_names}
-                if self.output_fmt=="quotes_sorted_and_labelled": 
-                    for i, col_name in enumerate(self.additional_info.columns[1:]):
-                        all_quotes[quote][col_name] = quote_val_list[i+2]
+                    subcat_vals = [quote_json[subcat_key] for subcat_key in self._subcat_keys]
+                    ## The page tag is appended unnormalized and closed by NUL bytes (which normalize_quote never emits),
+                    ## so a quote only matches on the same page: "[page 1]" must not become a substring of "[page 12]"
+                    norm_quote = b"%s\x00p%s\x00" % (normalize_quote(quote_json['quote']), str(quote_json['page_number']).encode("utf-8"))
+                    quote_id = similar_quotes.add()
+                    found_quotes.append((curr_quote, var_name, subcat_vals, norm_quote))
+                    first_id = first_id_by_norm.setdefault(norm_quote, quote_id)
+                    if first_id != quote_id:
+                        similar_quotes.union(first_id, quote_id)
+                        continue
+                    for candidate_id in quote_index.find_candidates(norm_quote):
+                        if is_similar_quote(norm_quote, found_quotes[candidate_id][3]):
+                            similar_quotes.union(candidate_id, quote_id)
+                    quote_index.add(quote_id, norm_quote)
+            all_quotes = {}
+            for quote_ids in similar_quotes.groups():
+                quote = found_quotes[quote_ids[0]][0]
+                all_quotes[quote] = {self._response_header: ", ".join(found_quotes[i][1] for i in quote_ids)}
+                for j, col_name in enumerate(self._subcats):
+                    all_quotes[quote][col_name] = ", ".join(str(found_quotes[i][2][j]) for i in quote_ids)
             return all_quotes
         
     def get_output_headers(self):
         if self.output_fmt == "quotes_gpt_resp":
             return ["Variable", "Relevant Quotes"]
         else:
-            headers = ["Quote", "Relevant Variables"]
-            if self.output_fmt == "quotes_sorted_and_labelled":
-                for subcat_header in self.additional_info.columns[1:]:
-                    headers.append(subcat_header)
-            return headers
-    
-    def get_chunk_size(self):
-        return 200
+            return ["Quote", "Relevant Variables", *self._subcats]
         
-    def get_num_excerpts(self, num_pages):
+    def get_num_excerpts(self, num_pages, char_count=None):
+        num_pages = self.get_text_pages(num_pages, char_count)
         if num_pages < 200:
             return 20 + num_pages
         else:
@@ -193,6 +387,12 @@ class QuoteAnalyzer(GPTAnalyzer):
         return "text" if self.output_fmt == "quotes_gpt_resp" else "json_object"
 
 class SummaryAnalyzer(GPTAnalyzer):
+    semantic_threshold = 0.9
+    chunk_size = 500
+    output_headers = ("Variable", "Summary")
+    resp_format = "text"
+    __slots__ = ()
+
     def __init__(self, pdfs, main_query, variable_specs, email, output_fmt, additional_info):
         super().__init__(pdfs, main_query, variable_specs, email, output_fmt, additional_info) 
     
@@ -205,28 +405,22 @@ class SummaryAnalyzer(GPTAnalyzer):
     def get_results(self, policy_info):
         resp = {}
         for var_name, r in policy_info.items():
-            resp[var_name] = {self.get_output_headers()[1]: r}      
+            resp[var_name] = {self._response_header: r}      
         return resp
     
-    def get_output_headers(self):
-        return ["Variable", "Summary"]
-    
-    def get_chunk_size(self):
-        return 500
-        
-    def get_num_excerpts(self, num_pages):
-        return 5 + num_pages
-    
-    def resp_format_type(self):
-        return "text"
+    def get_num_excerpts(self, num_pages, char_count=None):
+        return 5 + self.get_text_pages(num_pages, char_count)
+
+## Task type label -> analyzer class; built once at import, read-only
+_TASK_TYPES = MappingProxyType({
+    "Quote extraction": QuoteAnalyzer,
+    "Custom output format": CustomOutputAnalyzer,
+    "Targeted summaries": SummaryAnalyzer,
+    "Targeted inquiries": DefaultAnalyzer
+})
 
 def get_task_types():
-    return {
-        "Quote extraction": QuoteAnalyzer,
-        "Custom output format": CustomOutputAnalyzer,
-        "Targeted summaries": SummaryAnalyzer,
-        "Targeted inquiries": DefaultAnalyzer
-    }
+    return _TASK_TYPES
 
 def get_analyzer(task_type, output_fmt, pdfs, main_query, variable_specs, email, additional_info):
     task_analyzer_class = get_task_types()[task_type]
@@ -1,16 +1,78 @@
-from analysis import get_analyzer, get_task_types
+from analysis import GPTAnalyzer, get_analyzer, get_task_types
 
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail, Attachment, FileContent, FileName, FileType, Disposition
-from tempfile import NamedTemporaryFile
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import base64
+import hashlib
+import hmac
 import os
 import pandas as pd
+import shutil
 import streamlit as st
+import traceback
 import zipfile
 
 
-def load_header():
+_email_executor = ThreadPoolExecutor(max_workers=2)
+
+## Quote extraction output format label -> QuoteAnalyzer output_fmt
+OUTPUT_FORMAT_OPTIONS = {
+    'Sort by quotes; each quote will be one row': 'quotes_sorted',
+    'Simply return GPT responses for each variable': 'quotes_gpt_resp',
+    'Sort by quotes labelled with variable_name and subcategories': 'quotes_sorted_and_labelled',
+    'Return list of quotes per variable': 'quotes_structured',
+}
+_DEFAULT_OUTPUT_FORMAT = 'Simply return GPT responses for each variable'
+
+## (variable_name, variable_description) presets for the variables table
+_SDG_VARIABLES = (
+    ("SDG 1", "End poverty in all its forms everywhere"),
+    ("SDG 2", "End hunger, achieve food security and improved nutrition and promote sustainable agriculture"),
+    ("SDG 3", "Ensure healthy lives and promote well-being for all at all ages"),
+    ("SDG 4", "Ensure inclusive and equitable quality education and promote lifelong learning opportunities for all"),
+    ("SDG 5", "Achieve gender equality and empower all women and girls"),
+    ("SDG 6", "Ensure availability and sustainable management of water and sanitation for all"),
+    ("SDG 7", "Ensure access to affordable, reliable, sustainable and modern energy for all"),
+    ("SDG 8", "Promote sustained, inclusive and sustainable economic growth, full and productive employment and decent work for all"),
+    ("SDG 9", "Build resilient infrastructure, promote inclusive and sustainable industrialization and foster innovation"),
+    ("SDG 10", "Reduce inequality within and among countries"),
+    ("SDG 11", "Make cities and human settlements inclusive, safe, resilient and sustainable"),
+    ("SDG 12", "Ensure sustainable consumption and production patterns"),
+    ("SDG 13", "Take urgent action to combat climate change and its impacts"),
+    ("SDG 14", "Conserve and sustainably use the oceans, seas and marine resources for sustainable development"),
+    ("SDG 15", "Protect, restore and promote sustainable use of terrestrial ecosystems, sustainably manage forests, combat desertification, and halt and reverse land degradation and halt biodiversity loss"),
+    ("SDG 16", "Promote peaceful and inclusive societies for sustainable development, provide access to justice for all and build effective, accountable and inclusive institutions at all levels"),
+    ("SDG 17", "Strengthen the means of implementation and revitalize the Global Partnership for Sustainable Development"),
+)
+
+_JUST_TRANSITION_VARIABLES = (
+    ("gender", ""),
+    ("jobs", ""),
+    ("local communities and co-benefits", ""),
+    ("indigenous peoples", ""),
+    ("prior informed consent", ""),
+    ("human rights", ""),
+)
+
+## (st.secrets key of a passcode, st.secrets key of the OpenAI key it unlocks)
+_PASSCODE_APIKEY_IDS = (
+    ("access_password", "openai_apikey"),
+    ("access_password_adis", "openai_apikey_adis"),
+    ("access_password_stefan_mia", "openai_apikey_stefan_mia"),
+    ("access_password_guillaume", "openai_apikey_guillaume"),
+    ("access_password_sharone", "openai_apikey_sharone"),
+)
+
+## Every variables table column is free text; declaring it keeps the editor from inferring a type per rerun
+_VARIABLES_COLUMN_CONFIG = {col: st.column_config.TextColumn() for col in ("variable_name", "variable_description", "context")}
+
+## Preset tables are built once at import and copied into the session on click
+_SDG_DF = pd.DataFrame(_SDG_VARIABLES, columns=["variable_name", "variable_description"]).assign(context="")
+_JUST_TRANSITION_DF = pd.DataFrame(_JUST_TRANSITION_VARIABLES, columns=["variable_name", "variable_description"]).assign(context="")
+
+## The logo and header markup never change, so they are read and encoded once per process, not on every rerun
+@st.cache_resource
+def get_header_html():
     logo_path = os.path.join(os.path.dirname(__file__), 'public', 'logo.png')
     with open(logo_path, "rb") as image_file:
         encoded_string = base64.b64encode(image_file.read()).decode()
@@ -24,7 +86,10 @@ Users can define specific queries to extract targeted information from any colle
         <br>
     </div>
     """
-    st.markdown(html_temp, unsafe_allow_html=True)
+    return html_temp
+
+def load_header():
+    st.markdown(get_header_html(), unsafe_allow_html=True)
 
 def load_text():
     instructions = """
@@ -39,57 +104,118 @@ Reading through each uploaded policy document, this tool will ask ChatGPT the ma
 - **Step 6:** Hit “Run”. DO NOT CLOSE SESSION until you have received or downloaded results.
 - **Step 7:** Assess results, change parameters as needed, and repeat steps 1-6.
 - **Step 8:** Once results are satisfactory, contact aipolicyreader@sei.org for access to full batch-processing functionality.
-- **Step 9:** Re-run once more on all policy documents."""
+- **Step 9:** Re-run once more on all policy documents.
+
+## Submit your processing request"""
 
     st.markdown(instructions)
     #st.warning("Please first run on a subset of PDF's to fine-tune functionality. Repeatedly running on many PDF's causes avoidable AI-borne GHG emissions.", icon="⚠️")
-    st.markdown("""## Submit your processing request""")
 
-def upload_zip(temp_dir):
+## Returns {pdf file name: zip member name} and {duplicate file name: file name it duplicates}, leaving out other
+## members (e.g. macOS "__MACOSX/._*.pdf" metadata). Identical PDFs are run once and their results repeated under
+## each copy's name: the zip directory's CRC-32 and size pick out candidate copies without decompressing anything,
+## and only those are confirmed by SHA-256. A PDF whose file name is already taken by one in another folder gets
+## a numbered name ("a (2).pdf"), so every file name is unique.
+def list_pdf_members(zip_file):
+    pdf_members, duplicates = {}, {}
+    fnames_by_crc = {}
+    digests = {} # member name -> SHA-256, so each candidate is inflated and hashed at most once
+    with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+        def sha256(member_name):
+            if member_name not in digests:
+                with zip_ref.open(member_name) as f:
+                    digests[member_name] = hashlib.file_digest(f, "sha256").digest()
+            return digests[member_name]
+        for member in zip_ref.infolist():
+            fname = os.path.basename(member.filename)
+            if member.is_dir() or not fname.endswith(".pdf") or member.filename.startswith("__MACOSX/"):
+                continue
+            copy_num = 2
+            while fname in pdf_members or fname in duplicates:
+                fname = f"{os.path.basename(member.filename)[:-len('.pdf')]} ({copy_num}).pdf"
+                copy_num += 1
+            same_crc_fnames = fnames_by_crc.setdefault((member.CRC, member.file_size), [])
+            original = next((other for other in same_crc_fnames
+                             if sha256(pdf_members[other]) == sha256(member.filename)), None)
+            if original is not None:
+                duplicates[fname] = original
+                continue
+            same_crc_fnames.append(fname)
+            pdf_members[fname] = member.filename
+    return pdf_members, duplicates
+
+## Streams each zip member in pdf_members ({pdf file name: zip member name}, as from list_pdf_members) to
+## temp_dir/<pdf file name>, returning {pdf path: size in bytes} in pdf_members order; the size is the write offset
+## once copied, so no stat is needed. Only the listed file names are used, so member paths cannot escape temp_dir.
+## Members are inflated on parallel threads (zlib releases the GIL); ZipFile serializes the underlying reads of a
+## shared handle, so one handle serves every thread.
+def extract_pdfs(zip_file, pdf_members, temp_dir):
+    with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+        def extract_pdf(fname_and_member):
+            fname, member_name = fname_and_member
+            pdf_path = os.path.join(temp_dir, fname)
+            with zip_ref.open(member_name) as src, open(pdf_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 2**19)
+                return pdf_path, dst.tell()
+        with ThreadPoolExecutor(max_workers=max(1, min(len(pdf_members), os.cpu_count() or 1))) as executor:
+            return dict(executor.map(extract_pdf, pdf_members.items()))
+
+## Passcodes are looked up in st.secrets at most every 5 minutes rather than on every rerun of the passcode box;
+## the expiry lets a changed passcode take effect without restarting the app
+@st.cache_resource(ttl=300, show_spinner=False)
+def get_passcode_apikey_ids():
+    return tuple((st.secrets[passcode_id].encode(), apikey_id) for passcode_id, apikey_id in _PASSCODE_APIKEY_IDS)
+
+## Returns the OpenAI key id for passcode (None if it matches none). Every passcode is compared in constant time
+## so the response time does not reveal how much of a passcode was right
+def match_passcode(passcode):
+    matched_id = None
+    for secret, apikey_id in get_passcode_apikey_ids():
+        if hmac.compare_digest(passcode.encode(), secret):
+            matched_id = apikey_id
+    return matched_id
+
+def upload_zip():
     st.subheader("I. Upload Zipfile of PDF's")
     uploaded_zip = st.file_uploader("Compress a folder with your documents into a zip-file. The zip-file must have the same name as the folder. The folder must only contain PDF's; no subfolders allowed.", type="zip")
     st.markdown("*Please note: uploaded documents will be procesed by OpenAI and may be used to train futher models. If you are concerned about the confidentiality of your documents, please contact us before use.*")
     if uploaded_zip is not None:
         st.success("""Zip-file uploaded successfully! \n
 Please first run on a subset of PDF's to fine-tune functionality. Careless processing causes avoidable AI-borne GHG emissions.""", icon="✅")
-        pdfs = []
-        with NamedTemporaryFile(delete=False, suffix='.zip') as temp_zip:
-            temp_zip.write(uploaded_zip.getvalue())
-            st.session_state["temp_zip_path"] = temp_zip.name
-        with zipfile.ZipFile(st.session_state["temp_zip_path"], 'r') as zip_ref:
-            zip_ref.extractall(temp_dir)
-        for subdir in os.listdir(temp_dir):
-            subdir_path = os.path.join(temp_dir, subdir)
-            for filename in os.listdir(subdir_path):
-                if filename.endswith(".pdf"):
-                    file_path = os.path.join(subdir_path, filename)
-                    pdfs.append(file_path)  
-        st.session_state["pdfs"] = pdfs
+        # The uploaded file is a seekable in-memory buffer, so it is read in place rather than copied to disk first.
+        # Only its listing is read here; the PDFs that are actually run get extracted when "Run" is clicked.
+        st.session_state["uploaded_zip"] = uploaded_zip
+        # The listing is only rebuilt when a different zip-file is uploaded, not on every rerun of the page
+        if st.session_state.get("pdf_listing_id") != uploaded_zip.file_id:
+            st.session_state["pdf_members"], st.session_state["duplicate_pdfs"] = list_pdf_members(uploaded_zip)
+            st.session_state["pdfs"] = list(st.session_state["pdf_members"])
+            st.session_state["pdf_listing_id"] = uploaded_zip.file_id
+        renamed = [f"{member_name} (as {fname})" for fname, member_name in st.session_state["pdf_members"].items()
+                   if os.path.basename(member_name) != fname]
+        if renamed:
+            st.info("These PDFs share a file name with a PDF in another folder of the zip-file, so they were renamed: "
+                    + ", ".join(renamed))
+        duplicates = st.session_state["duplicate_pdfs"]
+        if duplicates:
+            st.info("These PDFs are identical to another in the zip-file, so they are analyzed once and share its results: "
+                    + ", ".join(f"{fname} (same as {original})" for fname, original in duplicates.items()))
+        pdfs = st.session_state["pdfs"]
         if 'max_files' not in st.session_state:
             st.session_state['max_files'] = 3
         if 'file_select_label' not in st.session_state:
             st.session_state['file_select_label'] = "Select 1-3 subfiles to run on"
         checked = st.checkbox('Run on subset', value=True, help="Do not turn this off until you are ready for your final run.")
         if checked:
-            fnames = {os.path.basename(p): p for p in pdfs}
-            first = os.path.basename(pdfs[0])      
-            selected_fnames = st.multiselect(st.session_state['file_select_label'], fnames.keys(), default=[first], max_selections=st.session_state["max_files"])
-            st.session_state['selected_pdfs'] = [fnames[selected_fname] for selected_fname in selected_fnames]
+            selected_fnames = st.multiselect(st.session_state['file_select_label'], pdfs, default=[pdfs[0]], max_selections=st.session_state["max_files"])
+            st.session_state['selected_pdfs'] = selected_fnames
         else:
             st.markdown("After fine-tuning the main query template and variable definitions below, you may run the "
                         "Tool for all policy documents of interest. Please contact william.babis@sei.org for access.")
             passcode = st.text_input("Enter passcode")
             if passcode:
-                apikey_ids = {
-                    st.secrets["access_password"]: "openai_apikey",
-                    st.secrets["access_password_adis"]: "openai_apikey_adis",
-                    st.secrets["access_password_stefan_mia"]: "openai_apikey_stefan_mia",
-                    st.secrets["access_password_guillaume"]: "openai_apikey_guillaume",
-                    st.secrets["access_password_sharone"]: "openai_apikey_sharone"
-
-                }
-                if passcode in apikey_ids:
-                    st.session_state['apikey_id'] = apikey_ids[passcode]
+                apikey_id = match_passcode(passcode)
+                if apikey_id is not None:
+                    st.session_state['apikey_id'] = apikey_id
                     st.session_state['is_test_run'] = False
                     st.session_state['max_files'] = None
                     st.session_state['file_select_label'] = "Select any number of PDFs to analyze. Or, uncheck 'Run on Subset' to analyze all uploaded PDFs"
@@ -113,41 +239,25 @@ def input_main_query():
     st.markdown(qtemplate_tips)
 
 def populate_with_SDGs():
-    sdg_df = pd.DataFrame([
-        {"variable_name": "SDG 1", "variable_description": "End poverty in all its forms everywhere", "context": ""},
-        {"variable_name": "SDG 2", "variable_description": "End hunger, achieve food security and improved nutrition and promote sustainable agriculture", "context": ""},
-        {"variable_name": "SDG 3", "variable_description": "Ensure healthy lives and promote well-being for all at all ages", "context": ""},
-        {"variable_name": "SDG 4", "variable_description": "Ensure inclusive and equitable quality education and promote lifelong learning opportunities for all", "context": ""},
-        {"variable_name": "SDG 5", "variable_description": "Achieve gender equality and empower all women and girls", "context": ""},
-        {"variable_name": "SDG 6", "variable_description": "Ensure availability and sustainable management of water and sanitation for all", "context": ""},
-        {"variable_name": "SDG 7", "variable_description": "Ensure access to affordable, reliable, sustainable and modern energy for all", "context": ""},
-        {"variable_name": "SDG 8", "variable_description": "Promote sustained, inclusive and sustainable economic growth, full and productive employment and decent work for all", "context": ""},
-        {"variable_name": "SDG 9", "variable_description": "Build resilient infrastructure, promote inclusive and sustainable industrialization and foster innovation", "context": ""},
-        {"variable_name": "SDG 10", "variable_description": "Reduce inequality within and among countries", "context": ""},
-        {"variable_name": "SDG 11", "variable_description": "Make cities and human settlements inclusive, safe, resilient and sustainable", "context": ""},
-        {"variable_name": "SDG 12", "variable_description": "Ensure sustainable consumption and production patterns", "context": ""},
-        {"variable_name": "SDG 13", "variable_description": "Take urgent action to combat climate change and its impacts", "context": ""},
-        {"variable_name": "SDG 14", "variable_description": "Conserve and sustainably use the oceans, seas and marine resources for sustainable development", "context": ""},
-        {"variable_name": "SDG 15", "variable_description": "Protect, restore and promote sustainable use of terrestrial ecosystems, sustainably manage forests, combat desertification, and halt and reverse land degradation and halt biodiversity loss", "context": ""},
-        {"variable_name": "SDG 16", "variable_description": "Promote peaceful and inclusive societies for sustainable development, provide access to justice for all and build effective, accountable and inclusive institutions at all levels", "context": ""},
-        {"variable_name": "SDG 17", "variable_description": "Strengthen the means of implementation and revitalize the Global Partnership for Sustainable Development", "context": ""}
-    ])
-    st.session_state["variables_df"] = sdg_df
+    st.session_state["variables_df"] = _SDG_DF.copy()
 
 def populate_with_just_transition():
-    just_transition_df = pd.DataFrame([
-        {"variable_name": "gender", "variable_description": "", "context": ""},
-        {"variable_name": "jobs", "variable_description": "", "context": ""},
-        {"variable_name": "local communities and co-benefits", "variable_description": "", "context": ""},
-        {"variable_name": "indigenous peoples", "variable_description": "", "context": ""},
-        {"variable_name": "prior informed consent", "variable_description": "", "context": ""},
-        {"variable_name": "human rights", "variable_description": "", "context": ""}
-    ])
-    st.session_state["variables_df"] = just_transition_df
+    st.session_state["variables_df"] = _JUST_TRANSITION_DF.copy()
 
 def clear_variables():
-    empty_df = pd.DataFrame([{"variable_name": None, "variable_description": None, "context": None}])
-    st.session_state["variables_df"] = empty_df
+    st.session_state["variables_df"] = st.session_state["variables_df"].iloc[0:0].copy()
+
+## Cell edits rerun only this table, not the whole page, and take effect immediately (Run always sees them).
+## Renaming, adding or removing a variable also reruns the page, so the per-variable tables in Advanced settings
+## are rebuilt from the new names.
+@st.fragment
+def input_variables_table():
+    col_order = ["variable_name", "variable_description", "context"]
+    st.session_state["schema_table"] = st.data_editor(st.session_state["variables_df"], num_rows="dynamic", use_container_width=True, 
+                   hide_index=True, column_order=col_order, column_config=_VARIABLES_COLUMN_CONFIG)
+    shown_var_names = st.session_state.get("shown_var_names")
+    if shown_var_names is not None and shown_var_names != st.session_state["schema_table"]["variable_name"].to_list():
+        st.rerun()
 
 def input_data_specs():
     st.markdown("")
@@ -155,18 +265,17 @@ def input_data_specs():
     hdr = ('For example, you may list particular SDGs as variables if you want to our tool to extract quotes '
            'from the policy documents that address an SDG. In this case, your list of variable names and descriptions '
            'would be *[SDG1: End poverty in all its forms everywhere, SDG2: End hunger, achieve food security..]*. '
-           'You may also click the "Populate with SDGs" button below.')
+           'You may also click the "Populate with SDGs" button below.\n\n'
+           '**Type-in variable details or copy-and-paste from an excel spreadsheet (3 columns, no headers).**')
     st.markdown(hdr)
-    st.markdown("**Type-in variable details or copy-and-paste from an excel spreadsheet (3 columns, no headers).**")
     if "variables_df" not in st.session_state:
         st.session_state["variables_df"] = pd.DataFrame([
             {"variable_name": "SDG 1", "variable_description": "End poverty in all its forms everywhere.", "context": ""},
             {"variable_name": "SDG 2", "variable_description": "End hunger, achieve food security and improved nutrition and promote sustainable agriculture.", "context": ""},
         ])
-    col_order = ["variable_name", "variable_description", "context"]
-    variables_df = st.session_state["variables_df"]
-    st.session_state["schema_table"] = st.data_editor(variables_df, num_rows="dynamic", use_container_width=True, 
-                   hide_index=True, column_order=col_order)
+    # Set again below once the page has been built from the table; cleared here so the table knows this is a full run
+    st.session_state.pop("shown_var_names", None)
+    input_variables_table()
     btn1, btn2, btn3 = st.columns([1, 1, 1])
     with btn1:
         st.button("Clear", on_click=clear_variables)
@@ -177,20 +286,24 @@ def input_data_specs():
     with st.expander("Advanced settings"):
         st.selectbox(
             'Optional: specify the overall operation type',
-            list(get_task_types().keys()),
+            get_task_types().keys(),
             key='task_type'
         )
-        var_names = list(st.session_state["schema_table"]["variable_name"].to_list())
+        st.number_input('Optional: maximum number of simultaneous GPT requests', min_value=1, max_value=64,
+                        value=GPTAnalyzer.max_concurrency, key='max_concurrency',
+                        help="Lower this if your OpenAI account hits rate limits.")
+        st.checkbox('Reuse saved GPT responses', value=True, key='use_cache',
+                    help="Responses to the same (or a near-identical) query on the same text are saved for 7 days and "
+                         "reused. Uncheck to query GPT again for every variable.")
+        var_names = st.session_state["schema_table"]["variable_name"].to_list()
+        st.session_state["shown_var_names"] = var_names
         if st.session_state["task_type"] == "Quote extraction":
-            options = st.session_state["output_format_options"]
-            if 'output_format' not in st.session_state:
-                st.session_state['output_format'] = list(options.keys())[1]
             st.selectbox(
                 'Optional: select format of output table for each document',
-                options.keys(),
+                OUTPUT_FORMAT_OPTIONS.keys(),
                 key='output_format'
             )
-            output_fmt_selected = st.session_state["output_format_options"][st.session_state["output_format"]]
+            output_fmt_selected = OUTPUT_FORMAT_OPTIONS[st.session_state["output_format"]]
             if output_fmt_selected == "quotes_sorted_and_labelled":
                 subcat_div1, subcat_div2 = st.columns([1, 1])
                 with subcat_div1:
@@ -214,82 +327,90 @@ def input_data_specs():
                                                                   disabled=["variable_name"], use_container_width=True)
 
 def process_table():
-    df = st.session_state["schema_table"]
-    df = df.fillna("")
+    df = st.session_state["schema_table"].fillna("")
     num_cols = df.shape[1]
     df.columns = ["column_name", "column_description", "context"][:num_cols] 
-    df['column_name'] = df['column_name'].replace('', pd.NA)
-    df.dropna(subset=['column_name'], inplace=True)
-    df = df[df['column_name'].notnull()]
-    return {row['column_name']: {'column_description': row['column_description'], **({'context': row['context']} if 'context' in df.columns else {})} for _, row in df.iterrows()}
+    # A repeated variable name keeps its last row's details; to_dict(orient='index') needs unique names
+    df = df[df['column_name'] != ""].drop_duplicates('column_name', keep='last')
+    return df.set_index('column_name').to_dict(orient='index')
 
 def input_email():
     st.markdown("For variables with short descriptions, processing time will be about 1 minute per 100 pdf-pages per variable.")
     st.session_state["email"] = st.text_input("Enter your email where you'd like to recieve the results:")
 
-def build_interface(tmp_dir):
+def build_interface():
     if 'task_type' not in st.session_state:
         st.session_state['task_type'] = 'Quote extraction'
     if 'is_test_run' not in st.session_state:
         st.session_state['is_test_run'] = True
     load_text()
-    upload_zip(tmp_dir)
+    upload_zip()
     input_main_query()
-    if "output_format_options" not in st.session_state:
-        st.session_state["output_format_options"] = {
-            'Sort by quotes; each quote will be one row': 'quotes_sorted',
-            'Simply return GPT responses for each variable': 'quotes_gpt_resp',
-            'Sort by quotes labelled with variable_name and subcategories': 'quotes_sorted_and_labelled',
-            'Return list of quotes per variable': 'quotes_structured',
-        }
     if 'pdfs' not in st.session_state:
         st.session_state['pdfs'] = 'no_upload'
     if 'schema_input_format' not in st.session_state:
         st.session_state['schema_input_format'] = 'Manual Entry'
     if 'output_format' not in st.session_state:
-        st.session_state['output_format'] = list(st.session_state["output_format_options"].keys())[1]
-    if "custom_output_fmt" not in st.session_state:
-        st.session_state["custom_output_fmt"] = None
-    if "output_detail_df" not in st.session_state:
-        st.session_state["output_detail_df"] = None
+        st.session_state['output_format'] = _DEFAULT_OUTPUT_FORMAT
     input_data_specs()
     st.divider()
     input_email()
 
-def email_results(docx_fname, recipient_email):
+## Attaching and sending run on a background thread so the results page does not wait on SendGrid;
+## secrets are read here, on the script thread. sendgrid is only imported once a run finishes, keeping it (and its
+## HTTP stack) out of every session's first render
+def email_results(docx_bytes, recipient_email, log):
+    from sendgrid.helpers.mail import Mail
+
     message = Mail(
         from_email=st.secrets["email"],
         to_emails=recipient_email,
         subject='Results: GPT Batch Policy Processor (Beta)',
         html_content='Attached is the document you requested.')
-    with open(docx_fname, 'rb') as f:
-        file_data = f.read()
-        f.close()
-    encoded_file = base64.b64encode(file_data).decode()
-    attachedFile = Attachment(
-        FileContent(encoded_file),
-        FileName('results.docx'),
-        FileType('application/docx'),
-        Disposition('attachment')
-    )
-    message.attachment = attachedFile
+    _email_executor.submit(send_email, message, docx_bytes, st.secrets["sendgrid_apikey"], log)
+
+@lru_cache(maxsize=None)
+def get_sendgrid_client(sendgrid_apikey):
+    from sendgrid import SendGridAPIClient
+
+    return SendGridAPIClient(sendgrid_apikey)
+
+## Runs on the email thread, where nothing reads its result, so failures are reported through log (main.log)
+def send_email(message, docx_bytes, sendgrid_apikey, log):
+    from sendgrid.helpers.mail import Attachment, FileContent, FileName, FileType, Disposition
+
     try:
-        sg = SendGridAPIClient(st.secrets["sendgrid_apikey"])
+        encoded_file = base64.b64encode(docx_bytes).decode()
+        attachedFile = Attachment(
+            FileContent(encoded_file),
+            FileName('results.docx'),
+            FileType('application/docx'),
+            Disposition('attachment')
+        )
+        message.attachment = attachedFile
+        sg = get_sendgrid_client(sendgrid_apikey)
         response = sg.send(message)
         print(response.status_code)
     except Exception as e:
         print(e)
-        print(e.message)
+        log(f"Error emailing results: {getattr(e, 'message', e)}")
+        log(traceback.format_exc())
 
-def get_user_inputs():
-    pdfs = st.session_state["pdfs"]
+def get_user_inputs(temp_dir):
+    pdf_fnames = st.session_state["pdfs"]
     if st.session_state["is_test_run"]:
-        pdfs = st.session_state["selected_pdfs"]
+        pdf_fnames = st.session_state["selected_pdfs"]
+    pdf_members = st.session_state["pdf_members"]
+    # Identical copies are only repeated in full runs: the subset picker lists each distinct PDF once, so a subset
+    # run covers just the PDFs picked
+    st.session_state["run_duplicate_pdfs"] = {} if st.session_state["is_test_run"] else st.session_state["duplicate_pdfs"]
+    st.session_state["pdf_sizes"] = extract_pdfs(st.session_state["uploaded_zip"], {fname: pdf_members[fname] for fname in pdf_fnames}, temp_dir)
+    pdfs = list(st.session_state["pdf_sizes"])
     main_query = st.session_state["main_query_input"]
     email = st.session_state["email"]
     column_specs = process_table()
     task_type = st.session_state["task_type"]
-    output_fmt = st.session_state["output_format_options"][st.session_state["output_format"]]
+    output_fmt = OUTPUT_FORMAT_OPTIONS[st.session_state["output_format"]]
     additional_info = None
     if task_type=="Quote extraction" and output_fmt == "quotes_sorted_and_labelled":
         additional_info = st.session_state["subcategories_df"]
@@ -297,15 +418,15 @@ def get_user_inputs():
         additional_info = {"custom_output_fmt": st.session_state["custom_output_fmt"],
                            "output_detail": st.session_state["output_detail_df"]
         }
-    return get_analyzer(task_type, output_fmt, pdfs, main_query, column_specs, email, additional_info)
-
-def display_output(docx_fname):
-    with open(docx_fname, 'rb') as f:
-        binary_file = f.read()
-        st.download_button(label="Download Results",
-                   data=binary_file,
-                   file_name="results.docx",
-                   mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document")
+    gpt_analyzer = get_analyzer(task_type, output_fmt, pdfs, main_query, column_specs, email, additional_info)
+    gpt_analyzer.use_cache = st.session_state.get("use_cache", True)
+    return gpt_analyzer
+
+def display_output(docx_bytes):
+    st.download_button(label="Download Results",
+                data=docx_bytes,
+                file_name="results.docx",
+                mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document")
 
 def about_tab():
     text = """
@@ -2,11 +2,15 @@ from interface import about_tab, FAQ, build_interface, display_output, email_res
 from query_gpt import new_openai_session, query_gpt_for_column
 from read_pdf import extract_text_chunks_from_pdf
 from relevant_excerpts import generate_all_embeddings, embed_schema, find_top_relevant_texts
-from results import format_output_doc, get_output_fname, output_results, output_metrics
+from results import format_output_doc, output_results, output_metrics
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from docx import Document
-from tempfile import NamedTemporaryFile, TemporaryDirectory
+from io import BytesIO
+from tempfile import TemporaryDirectory
+import asyncio
 import json
+import multiprocessing
 import os
 import requests
 import streamlit as st
@@ -29,19 +33,83 @@ def get_schema():
             schema[key] = value 
     return schema, main_query, False
 
-def extract_policy_doc_info(gpt_analyzer, text_embeddings, input_text_chunks, char_count, var_embeddings, num_excerpts, openai_apikey):
-    policy_doc_data = {}
-    text_chunks = input_text_chunks
-    client, gpt_model, max_num_chars = new_openai_session(openai_apikey)
+async def extract_policy_doc_info(gpt_analyzer, text_embeddings, input_text_chunks, char_count, var_embeddings, num_excerpts, client, gpt_model, max_num_chars, gpt_semaphore):
     run_on_full_text = char_count < (max_num_chars - 1000)
-    for var_name in var_embeddings:
+    async def query_variable(var_name):
         col_embedding, col_desc, context = var_embeddings[var_name]["embedding"], var_embeddings[var_name]["column_description"], var_embeddings[var_name]["context"], 
+        text_chunks = input_text_chunks
         if not run_on_full_text: 
             top_text_chunks_w_emb = find_top_relevant_texts(text_embeddings, input_text_chunks, col_embedding, num_excerpts, var_name)
             text_chunks = [chunk_tuple[1] for chunk_tuple in top_text_chunks_w_emb]
-        resp = query_gpt_for_column(gpt_analyzer, var_name, col_desc, context, text_chunks, run_on_full_text, client, gpt_model)
-        policy_doc_data[var_name] = gpt_analyzer.format_gpt_response(resp)
-    return policy_doc_data
+        resp = await query_gpt_for_column(gpt_analyzer, var_name, col_desc, context, col_embedding, text_chunks, run_on_full_text, client, gpt_model, gpt_semaphore)
+        return var_name, gpt_analyzer.format_gpt_response(resp)
+    policy_doc_data = await asyncio.gather(*(query_variable(var_name) for var_name in var_embeddings))
+    return dict(policy_doc_data)
+
+## Returns (pdf, [(output pdf path, policy_info) per section], number of pages read, whether the pdf could not be read)
+async def extract_pdf_info(gpt_analyzer, pdf, var_embeddings, client, gpt_model, max_num_chars, gpt_semaphore, pdf_executor):
+    pdf_path = get_resource_path(f"{pdf.replace('.pdf','')}.pdf")
+    section_results = []
+    num_pages_in_pdf = 0
+    try:
+        country_start_time = time.time()
+        # 1) read pdf
+        text_chunk_size = gpt_analyzer.chunk_size
+        text_sections = await asyncio.get_running_loop().run_in_executor(pdf_executor, extract_text_chunks_from_pdf, pdf_path, text_chunk_size)
+        if text_sections[0][0] == None:
+            exception = text_sections[0][1]
+            return pdf, section_results, num_pages_in_pdf, True
+        for text_section in text_sections:
+            text_chunks, num_pages, char_count, section = text_section
+            num_pages_in_pdf += num_pages
+            # 2) Prepare embeddings to grab most relevant text excerpts for each column
+            #schema, main_query, compare_output_bool = get_schema()
+            pdf_embeddings, pdf_text_chunks = await asyncio.to_thread(generate_all_embeddings, client, pdf_path, text_chunks, get_resource_path) 
+
+            # 3) Iterate through each column to grab relevant texts and query
+            num_excerpts = gpt_analyzer.get_num_excerpts(num_pages, char_count)
+            policy_info = await extract_policy_doc_info(gpt_analyzer, pdf_embeddings, pdf_text_chunks, char_count, var_embeddings, num_excerpts, client, gpt_model, max_num_chars, gpt_semaphore)
+            output_pdf_path = pdf_path
+            if section != None:
+                output_pdf_path = f"{pdf_path} ({section} of {len(text_sections)})"
+            section_results.append((output_pdf_path, policy_info))
+        print_milestone("Done", country_start_time, {"Number of pages in PDF": num_pages_in_pdf})
+    except Exception as e:
+        # log makes blocking requests to the gist, so it runs off the event loop to keep other PDFs' queries moving
+        error_trace = traceback.format_exc()
+        await asyncio.to_thread(log, f"Error for {pdf}: {e}")
+        await asyncio.to_thread(log, error_trace)
+    return pdf, section_results, num_pages_in_pdf, False
+
+## All PDFs are processed concurrently in one event loop; the shared semaphore bounds the GPT requests in flight
+## across the whole batch to max_concurrency. Results come back in the order of gpt_analyzer.pdfs, and
+## progress_bar is advanced as each PDF finishes. PDFs are started largest first (by pdf_sizes, {pdf path: bytes})
+## so a big document is not left running alone at the end of the batch.
+async def extract_all_pdf_info(gpt_analyzer, var_embeddings, client, gpt_model, max_num_chars, max_concurrency, progress_bar, pdf_sizes):
+    # GPT calls run in worker threads; size the pool so the semaphore, not the pool, limits concurrency, with
+    # room left over for the cache lookups and embedding requests that also run there
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=max_concurrency + (os.cpu_count() or 1)))
+    gpt_semaphore = asyncio.Semaphore(max_concurrency)
+    # Text extraction is CPU-bound and holds the GIL, so PDFs are parsed in separate processes; each PDF's
+    # GPT requests start as soon as its own text is ready
+    num_pdfs, num_done = len(gpt_analyzer.pdfs), 0
+    # Workers come from a forkserver where available rather than fork: forking the multi-threaded Streamlit server
+    # can deadlock a child on a lock some other thread held. This is not free: like spawn (the default, and only
+    # option, on Windows), it re-imports main.py as __mp_main__ and with it interface, analysis, streamlit, pandas
+    # and openai (the app itself stays behind the __main__ guard), about a second per worker.
+    mp_context = None
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        mp_context = multiprocessing.get_context("forkserver")
+    with ProcessPoolExecutor(max_workers=max(1, min(num_pdfs, os.cpu_count() or 1)), mp_context=mp_context) as pdf_executor:
+        async def extract_and_report(pdf):
+            nonlocal num_done
+            pdf_result = await extract_pdf_info(gpt_analyzer, pdf, var_embeddings, client, gpt_model, max_num_chars, gpt_semaphore, pdf_executor)
+            num_done += 1
+            progress_bar.progress(num_done / num_pdfs, text=f"Processed {num_done} of {num_pdfs} documents")
+            return pdf_result
+        largest_first = sorted(gpt_analyzer.pdfs, key=lambda pdf: pdf_sizes.get(pdf, 0), reverse=True)
+        tasks = {pdf: asyncio.ensure_future(extract_and_report(pdf)) for pdf in largest_first}
+        return await asyncio.gather(*(tasks[pdf] for pdf in gpt_analyzer.pdfs))
 
 def print_milestone(milestone_desc, last_milestone_time, extras={}, mins=True):
     unit = "minutes" if mins else "seconds"
@@ -73,53 +141,53 @@ def log(new_content):
         data = {'files': {log_fname: {'content': updated_content}}}
         requests.patch(gist_url, headers=headers, data=json.dumps(data))
 
-def main(gpt_analyzer, openai_apikey):
+## duplicate_pdfs: {file name: file name of the identical PDF that was analyzed in its place}, for the copies to
+## repeat in this run's output
+def main(gpt_analyzer, openai_apikey, max_concurrency, pdf_sizes, duplicate_pdfs):
     compare_output_bool = False
     output_doc = Document()
     format_output_doc(output_doc, gpt_analyzer)
     total_num_pages = 0
     total_start_time = time.time()
     failed_pdfs = []
-    for pdf in gpt_analyzer.pdfs:
-        pdf_path = get_resource_path(f"{pdf.replace('.pdf','')}.pdf")
+    # The variables are the same for every PDF, so their embeddings are computed once per run
+    openai_client, gpt_model, max_num_chars = new_openai_session(openai_apikey)
+    var_embeddings = embed_schema(openai_client, gpt_analyzer.variable_specs) # i.e. {"col_name": {"embedding": <...>", "column_description": <...>, "context": <...>},  ...}
+    # The event loop runs on the script thread, so the coroutines can update the progress bar directly
+    progress_bar = st.progress(0.0, text=f"Processed 0 of {len(gpt_analyzer.pdfs)} documents")
+    pdf_results = asyncio.run(extract_all_pdf_info(gpt_analyzer, var_embeddings, openai_client, gpt_model, max_num_chars, max_concurrency, progress_bar, pdf_sizes))
+    progress_bar.empty()
+    # 4) Output Results
+    copy_fnames = {}
+    for copy_fname, original_fname in duplicate_pdfs.items():
+        copy_fnames.setdefault(original_fname, []).append(copy_fname)
+    num_docs = 0
+    for pdf, section_results, num_pages_in_pdf, read_failed in pdf_results:
+        # Identical copies share the PDF's outcome: they are counted, and listed as failed if it could not be read
+        fname = os.path.basename(pdf)
+        pdf_copies = [os.path.join(os.path.dirname(pdf), copy_fname) for copy_fname in copy_fnames.get(fname, [])]
+        num_docs += 1 + len(pdf_copies)
+        if read_failed:
+            failed_pdfs.extend([pdf, *pdf_copies])
+        total_num_pages += num_pages_in_pdf
         try:
-            country_start_time = time.time()
-            # 1) read pdf
-            text_chunk_size = gpt_analyzer.get_chunk_size()
-            text_sections = extract_text_chunks_from_pdf(pdf_path, text_chunk_size)
-            if text_sections[0][0] == None:
-                exception = text_sections[0][1]
-                failed_pdfs.append(pdf)
-                continue
-            num_pages_in_pdf = 0
-            for text_section in text_sections:
-                text_chunks, num_pages, char_count, section = text_section
-                num_pages_in_pdf += num_pages
-                total_num_pages += num_pages
-                openai_client, _, _ = new_openai_session(openai_apikey)
-                pdf_embeddings, pdf_text_chunks = generate_all_embeddings(openai_client, pdf_path, text_chunks, get_resource_path) 
-                # 2) Prepare embeddings to grab most relevant text excerpts for each column
-                #schema, main_query, compare_output_bool = get_schema()
-                openai_client, _, _ = new_openai_session(openai_apikey)
-                var_embeddings = embed_schema(openai_client, gpt_analyzer.variable_specs) # i.e. {"col_name": {"embedding": <...>", "column_description": <...>, "context": <...>},  ...}
-
-                # 3) Iterate through each column to grab relevant texts and query
-                num_excerpts = gpt_analyzer.get_num_excerpts(num_pages)
-                policy_info = extract_policy_doc_info(gpt_analyzer, pdf_embeddings, pdf_text_chunks, char_count, var_embeddings, num_excerpts, openai_apikey)
-                # 4) Output Results
-                output_pdf_path = pdf_path
-                if section != None:
-                    output_pdf_path = f"{pdf_path} ({section} of {len(text_sections)})"
+            for output_pdf_path, policy_info in section_results:
                 output_results(gpt_analyzer, output_doc, output_pdf_path, policy_info)
-            print_milestone("Done", country_start_time, {"Number of pages in PDF": num_pages_in_pdf})
+                # Identical copies get the same tables under their own names (keeping any "(i of n)" section suffix)
+                pdf_dir, section_name = os.path.split(output_pdf_path)
+                for copy_fname in copy_fnames.get(fname, []):
+                    output_results(gpt_analyzer, output_doc, os.path.join(pdf_dir, copy_fname + section_name[len(fname):]), policy_info)
         except Exception as e:
             log(f"Error for {pdf}: {e}")
             log(traceback.format_exc())
-    output_metrics(output_doc, len(gpt_analyzer.pdfs), time.time() - total_start_time, total_num_pages, failed_pdfs)
-    output_fname = get_output_fname(get_resource_path)
-    output_doc.save(output_fname)
-    email_results(output_fname, gpt_analyzer.email)
-    display_output(output_fname)
+    output_metrics(output_doc, num_docs, time.time() - total_start_time, total_num_pages, failed_pdfs)
+    # The document is kept in memory for both the email and the download; concurrent sessions no longer
+    # share a results file on disk
+    output_buffer = BytesIO()
+    output_doc.save(output_buffer)
+    docx_bytes = output_buffer.getvalue()
+    email_results(docx_bytes, gpt_analyzer.email, log)
+    display_output(docx_bytes)
     return total_num_pages
 
 if __name__ == "__main__":
@@ -136,18 +204,19 @@ if __name__ == "__main__":
             with centered_div:
                 tab1, tab2, tab3 = st.tabs(["Tool", "About", "FAQ"])
                 with tab1:
-                    build_interface(temp_dir)
+                    build_interface()
                     if st.button("Run"):
-                        gpt_analyzer = get_user_inputs()
+                        gpt_analyzer = get_user_inputs(temp_dir)
                         with st.spinner('Generating output document...'):
                             apikey_id = "openai_apikey"
                             if "apikey_id" in st.session_state:
                                 apikey_id = st.session_state["apikey_id"]
                             openai_apikey = st.secrets[apikey_id]
-                            num_pages = main(gpt_analyzer, openai_apikey)
+                            max_concurrency = st.session_state.get("max_concurrency", gpt_analyzer.max_concurrency)
+                            num_pages = main(gpt_analyzer, openai_apikey, max_concurrency, st.session_state.get("pdf_sizes", {}),
+                                             st.session_state.get("run_duplicate_pdfs", {}))
                             log(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())} GMT --> apikey_id; {num_pages} pages; {gpt_analyzer}")
                         st.success('Document generated!')
-                        os.unlink(st.session_state["temp_zip_path"])
                 with tab2:
                     about_tab()
                 with tab3:
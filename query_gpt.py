@@ -1,13 +1,26 @@
+from functools import lru_cache
 from openai import OpenAI
-import os
+import asyncio
+
+## One client per API key for the life of the process, so its pooled keep-alive connections are reused across
+## requests and runs. The key is passed to the client rather than set in the environment, which concurrent
+## sessions using different keys would overwrite.
+@lru_cache(maxsize=None)
+def get_openai_client(openai_apikey):
+    # The client retries 429 (rate limit), timeout and 5xx responses with exponential backoff and jitter,
+    # honouring any Retry-After header; bursts of concurrent requests need more than the default 2 retries
+    return OpenAI(api_key=openai_apikey, max_retries=6)
 
 def new_openai_session(openai_apikey):
-    os.environ["OPENAI_API_KEY"] = openai_apikey
-    client = OpenAI()
+    client = get_openai_client(openai_apikey)
     gpt_model = "gpt-4o" #"o1-preview"
     max_num_chars = 25000
     return client, gpt_model, max_num_chars
 
+## Part of every response cache key; bump it whenever the system prompt or message layout below changes,
+## so responses to the old prompts are not reused
+PROMPT_VERSION = 1
+
 def create_gpt_messages(query, run_on_full_text):
     text_label = "collection of text excerpts"
     if run_on_full_text:
@@ -22,7 +35,7 @@ def chat_gpt_query(gpt_client, gpt_model, resp_fmt, msgs):
     response = gpt_client.chat.completions.create(
         model=gpt_model,
         temperature=0,
-        response_format={"type": resp_fmt},
+        response_format=resp_fmt,
         messages=msgs
     )
     return response.choices[0].message.content
@@ -36,14 +49,16 @@ def fetch_column_info(gpt_client, gpt_model, query, resp_fmt, run_on_full_text):
     follow_up_response = chat_gpt_query(gpt_client, gpt_model, resp_fmt, msgs)
     return follow_up_response"""
 
-def query_gpt_for_column(gpt_analyzer, variable_name, col_spec, context, relevant_texts, run_on_full_text, gpt_client, gpt_model):
-    query_template = gpt_analyzer.main_query
+## gpt_semaphore bounds the number of concurrent requests to OpenAI; cache hits do not take a slot
+## col_embedding: the variable's embedding from embed_schema, reused to match near-duplicate cached queries
+async def query_gpt_for_column(gpt_analyzer, variable_name, col_spec, context, col_embedding, relevant_texts, run_on_full_text, gpt_client, gpt_model, gpt_semaphore):
     excerpts = '\n'.join(relevant_texts)
-    main_query = f"{query_template.format(variable_name=variable_name, variable_description=col_spec, context=context)} \n\n"
-    main_query = gpt_analyzer.optional_add_categorization(variable_name, main_query)
-    output_prompt = gpt_analyzer.output_fmt_prompt(variable_name)
-    if len(output_prompt) > 1:
-        output_prompt = " " + output_prompt
-    prompt = f'<instructions>{main_query}.{output_prompt}</instructions> \n\n """{excerpts}"""'
-    resp_fmt = gpt_analyzer.resp_format_type()
-    return fetch_column_info(gpt_client, gpt_model, prompt, resp_fmt, run_on_full_text)
\ No newline at end of file
+    query = gpt_analyzer.variable_query(variable_name, col_spec, context)
+    # Text first, per-variable instructions last: for full-document runs every variable then shares the same
+    # long prompt prefix, which OpenAI's prompt caching can reuse across requests
+    prompt = f'"""{excerpts}""" \n\n {query}'
+    resp_fmt = gpt_analyzer.response_format()
+    async def call_gpt():
+        async with gpt_semaphore:
+            return await asyncio.to_thread(fetch_column_info, gpt_client, gpt_model, prompt, resp_fmt, run_on_full_text)
+    return await gpt_analyzer.cached_or_call(gpt_model, variable_name, col_embedding, query, excerpts, run_on_full_text, call_gpt)
\ No newline at end of file
@@ -1,19 +1,23 @@
-import json
+import hashlib
 import numpy as np
+import orjson
 import os
 
-def get_cache_fname(pdf_path, path_fxn):
+## Keyed by the chunks' content as well as the file name: the sections of a long PDF, runs with a different
+## chunk size, and different uploads with the same file name each get their own cache file
+def get_cache_fname(pdf_path, text_chunks, path_fxn):
     pdf_fname = os.path.basename(pdf_path)
     cache_dir = path_fxn(f"embeddings_cache")
     if not os.path.exists(cache_dir):
         os.makedirs(cache_dir)
-    return f"{cache_dir}/{pdf_fname.replace('.pdf','.json')}"
+    chunks_hash = hashlib.blake2b(orjson.dumps(text_chunks), digest_size=8).hexdigest()
+    return f"{cache_dir}/{pdf_fname.replace('.pdf','')}-{chunks_hash}.json"
 
 def cache_embeddings(embeddings, text_chunks, pdf_file_path, path_fxn):
-    json_file_path = get_cache_fname(pdf_file_path, path_fxn)
+    json_file_path = get_cache_fname(pdf_file_path, text_chunks, path_fxn)
     output_dict = {"embeddings": embeddings, "text_chunks": text_chunks}
-    with open(json_file_path, "w", encoding="utf-8") as f:
-        json.dump(output_dict, f)
+    with open(json_file_path, "wb") as f:
+        f.write(orjson.dumps(output_dict))
 
 def generate_embedding(openai_client, text):
     response = openai_client.embeddings.create(
@@ -23,10 +27,10 @@ def generate_embedding(openai_client, text):
     return response.data[0].embedding
 
 def generate_all_embeddings(openai_client, pdf_path, text_chunks, path_fxn):
-    cache_fname = get_cache_fname(pdf_path, path_fxn)
+    cache_fname = get_cache_fname(pdf_path, text_chunks, path_fxn)
     if os.path.exists(cache_fname):
-        with open(cache_fname, "r", encoding="utf-8") as f:
-            cached_embeddings = json.load(f)
+        with open(cache_fname, "rb") as f:
+            cached_embeddings = orjson.loads(f.read())
             return cached_embeddings["embeddings"], cached_embeddings["text_chunks"]
     else:
         embeddings = [generate_embedding(openai_client, t) for t in text_chunks]
@@ -0,0 +1,61 @@
+from contextlib import closing
+import hashlib
+import numpy as np
+import orjson
+import sqlite3
+import time
+
+def make_cache_key(*parts):
+    key_bytes = orjson.dumps(parts, option=orjson.OPT_SORT_KEYS, default=str)
+    return hashlib.blake2b(key_bytes).hexdigest()
+
+## Persistent key -> GPT response store shared across runs (and across concurrent sessions via WAL).
+## A second table maps each key to an embedding (of the variable's description) so reworded descriptions
+## within the same scope (same model, prompt template, variable and excerpts) can reuse a response. Responses older than ttl seconds are
+## ignored, and deleted whenever a cache is opened.
+class ResponseCache:
+    def __init__(self, db_fname, ttl=7 * 24 * 60 * 60):
+        self.db_fname = db_fname
+        self.ttl = ttl
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, resp BLOB, ts INTEGER)")
+            conn.execute("CREATE TABLE IF NOT EXISTS semantic (key TEXT PRIMARY KEY, scope TEXT, embedding BLOB)")
+            conn.execute("CREATE INDEX IF NOT EXISTS semantic_scope ON semantic (scope)")
+            conn.execute("DELETE FROM cache WHERE ts < ?", (self._oldest_ts(),))
+            conn.execute("DELETE FROM semantic WHERE key NOT IN (SELECT key FROM cache)")
+
+    def _oldest_ts(self):
+        return int(time.time()) - self.ttl
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_fname, timeout=30)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def get(self, key):
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT resp FROM cache WHERE key=? AND ts>=?", (key, self._oldest_ts())).fetchone()
+        return None if row is None else row[0]
+
+    def set(self, key, resp, scope=None, embedding=None):
+        with closing(self._connect()) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO cache (key, resp, ts) VALUES (?, ?, ?)", (key, resp, int(time.time())))
+            if scope is not None and embedding is not None:
+                emb_blob = np.asarray(embedding, dtype=np.float32).tobytes()
+                conn.execute("INSERT OR REPLACE INTO semantic (key, scope, embedding) VALUES (?, ?, ?)", (key, scope, emb_blob))
+
+    ## Returns the response whose query embedding is most similar to embedding (if >= threshold) within scope
+    def get_similar(self, scope, embedding, threshold):
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT semantic.key, embedding FROM semantic JOIN cache ON cache.key = semantic.key "
+                                "WHERE scope=? AND ts>=?", (scope, self._oldest_ts())).fetchall()
+        if not rows:
+            return None
+        cached_embs = np.stack([np.frombuffer(emb_blob, dtype=np.float32) for _, emb_blob in rows])
+        query_emb = np.asarray(embedding, dtype=np.float32)
+        similarities = cached_embs @ query_emb / (np.linalg.norm(cached_embs, axis=1) * np.linalg.norm(query_emb))
+        best_i = int(np.argmax(similarities))
+        if similarities[best_i] < threshold:
+            return None
+        return self.get(rows[best_i][0])
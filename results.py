@@ -3,9 +3,6 @@ from docx.shared import Pt
 import os
 import pandas as pd
 
-def get_output_fname(path_fxn, filetype="docx"):
-    return path_fxn(f"results.{filetype}")
-
 # rows_dict: {row_id: {"col_name": val, ...}}
 def create_word_table(doc, pdf_path, rows_dict, output_headers):
     fname = os.path.basename(pdf_path)